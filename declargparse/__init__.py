@@ -1,9 +1,6 @@
 # -*- mode: python; -*-
 import argparse
 from dataclasses import dataclass, field
-from datetime import datetime
-from functools import partial, reduce
-from itertools import chain
 import os
 import re
 import sys
@@ -18,11 +15,29 @@ from typing import (
     Optional,
     Sequence,
     Tuple,
+    TYPE_CHECKING,
     Union,
 )
 
+if TYPE_CHECKING:
+    from datetime import datetime
+
+_TZ_COLON_RE = re.compile(r":(\d\d)$")
+_ISO_DATETIME_RE = re.compile(
+    r"\d{4}-\d\d-\d\dT(?:[01]\d|2[0-3]):[0-5]\d:[0-5]\d"
+    r"(?:Z|[+-]\d\d:?[0-5]\d)",
+    re.ASCII,
+)
+
+# Since Python 3.14, argparse checks the environment to decide whether
+# to colorize output each time it constructs a formatter.
+_COLOR_KW: Dict[str, Any] = (
+    {"color": False} if sys.version_info >= (3, 14) else {}
+)
+
 
 class EnvVar:
+    __slots__ = ("name", "value")
     name: str
     value: Optional[str]
 
@@ -36,12 +51,35 @@ class EnvVar:
 
 
 class ArgSpec:
+    __slots__ = (
+        "args",
+        "kwargs",
+        "_action",
+        "_required",
+        "_has_default",
+        "_help",
+        "_envvars",
+        "_kw_cache",
+    )
     args: Tuple[str, ...]
     kwargs: Dict[str, Any]
+    _action: Optional[argparse.Action]
+    _required: bool
+    _has_default: bool
+    _help: Optional[str]
+    _envvars: Dict[str, EnvVar]
+    _kw_cache: Dict[Optional[str], Tuple[Optional[EnvVar], Dict[str, Any]]]
 
     def __init__(self, *args: str, **kwargs: Any) -> None:
         self.args = args
         self.kwargs = kwargs
+        self._action = None
+        self._required = bool(kwargs.get("required"))
+        self._has_default = "default" in kwargs
+        helpstr = kwargs.get("help")
+        self._help = helpstr if isinstance(helpstr, str) else None
+        self._envvars = {}
+        self._kw_cache = {}
 
     @property
     def dest(self) -> str:
@@ -53,18 +91,41 @@ class ArgSpec:
 
     @property
     def required(self) -> bool:
-        return bool(self.kwargs.get("required"))
+        return self._required
 
     @property
     def envvarbase(self) -> str:
         return self.dest.upper()
 
     def makeaction(self) -> argparse.Action:
-        parser = argparse.ArgumentParser()
-        return parser.add_argument(*self.args, **self.kwargs)
+        """Return the action for this argument specification.
+
+        The action is constructed on first use and cached.
+
+        """
+        if self._action is None:
+            parser = argparse.ArgumentParser(add_help=False, **_COLOR_KW)
+            self._action = parser.add_argument(*self.args, **self.kwargs)
+        return self._action
 
     def construct_envvar(self, envvar_prefix: str) -> EnvVar:
-        return EnvVar(f"{envvar_prefix}_{self.envvarbase}")
+        """Return the environment variable for this argument.
+
+        The environment is read once per prefix and cached; call
+        `invalidate` to read it again.
+
+        """
+        envvar = self._envvars.get(envvar_prefix)
+        if envvar is None:
+            envvar = self._envvars[envvar_prefix] = EnvVar(
+                f"{envvar_prefix}_{self.envvarbase}"
+            )
+        return envvar
+
+    def invalidate(self) -> None:
+        """Discard cached environment variables and keyword arguments."""
+        self._envvars.clear()
+        self._kw_cache.clear()
 
     def enhance_kwargs(
         self, envvar_prefix: Optional[str] = None
@@ -88,44 +149,34 @@ class ArgSpec:
           then replace the default value with the value of the
           environment variable.
 
+        The result is cached per environment variable prefix, and a
+        copy is returned so that callers may modify it.
+
         """
         if envvar_prefix is not None:
             envvar = self.construct_envvar(envvar_prefix)
         else:
             envvar = None
-
-        transformations = [
-            (
-                partial(drop_key, "required")
-                if self.kwargs.get("required")
-                and ("default" in self.kwargs or envvar is not None)
-                else None
-            ),
-            (
-                partial(annotate_helpstr, "required")
-                if self.kwargs.get("required")
-                else None
-            ),
-            (
-                partial(
-                    annotate_helpstr, f"environment variable: {envvar.name}"
+        cached = self._kw_cache.get(envvar_prefix)
+        if cached is not None and cached[0] is envvar:
+            return dict(cached[1])
+
+        kwargs = dict(self.kwargs)
+        if self._required and (self._has_default or envvar is not None):
+            del kwargs["required"]
+        helpstr = self._help
+        if helpstr is not None:
+            if self._required:
+                helpstr = add_annotation_to_helpstr("required", helpstr)
+            if envvar is not None:
+                helpstr = add_annotation_to_helpstr(
+                    f"environment variable: {envvar.name}", helpstr
                 )
-                if envvar is not None and "help" in self.kwargs
-                else None
-            ),
-            (
-                partial(replace_default, envvar.value)
-                if envvar is not None and envvar.value is not None
-                else None
-            ),
-        ]
-        return dict(
-            reduce(
-                lambda x, f: f(x) if f is not None else x,  # type: ignore
-                transformations,
-                self.kwargs.items(),
-            )
-        )
+            kwargs["help"] = helpstr
+        if envvar is not None and envvar.value is not None:
+            kwargs["default"] = envvar.value
+        self._kw_cache[envvar_prefix] = (envvar, dict(kwargs))
+        return kwargs
 
 
 def drop_key(
@@ -159,7 +210,10 @@ def replace_default(
     pairs: Iterable[Tuple[str, Any]],
 ) -> Iterator[Tuple[str, Any]]:
     """Drop default from pairs and then add with given default value."""
-    return chain(drop_key("default", pairs), [("default", defaultvalue)])
+    d = dict(pairs)
+    d.pop("default", None)
+    d["default"] = defaultvalue
+    return iter(d.items())
 
 
 def add_annotation_to_helpstr(annotation: str, helpstr: str) -> str:
@@ -173,18 +227,70 @@ def add_annotation_to_helpstr(annotation: str, helpstr: str) -> str:
     ... )
     'apply option (default: 1, env var: APP_OPT, required)'
 
+    Only a parenthetical on the last line is extended, and a single
+    trailing newline is kept at the end.
+
+    >>> add_annotation_to_helpstr('required', 'apply (default:\\n1)')
+    'apply (default:\\n1) (required)'
+    >>> add_annotation_to_helpstr('required', 'apply (default: 1)\\n')
+    'apply (default: 1, required)\\n'
+
     """
-    match = re.search(r"\((.*)\)$", helpstr)
-    if match:
-        pattrs = match.group(1).split(", ")
-        newattrstr = ", ".join(pattrs + [annotation])
-        enhancedhelpstr = re.sub(r"\(.*\)$", f"({newattrstr})", helpstr)
+    if helpstr.endswith("\n"):
+        body, newline = helpstr[:-1], "\n"
+    else:
+        body, newline = helpstr, ""
+    if body.endswith(")") and "(" in body[body.rfind("\n") + 1 :]:
+        enhancedhelpstr = f"{body[:-1]}, {annotation}){newline}"
     else:
         enhancedhelpstr = f"{helpstr} ({annotation})"
     return enhancedhelpstr
 
 
+class _LazyArgumentParser(argparse.ArgumentParser):
+    """Argument parser that adds its arguments on first use.
+
+    Subcommand parsers are constructed with this class so that only
+    the parser for the selected subcommand has its arguments added.
+
+    >>> spec = CliSpec(
+    ...     {"prog": "app"},
+    ...     subcmdgroup=SubcmdGroup(
+    ...         [SubcmdSpec("stop", lambda args: 0, [ArgSpec("name")])]
+    ...     ),
+    ... )
+    >>> try:
+    ...     spec.parseargs(["stop", "--help"])
+    ... except SystemExit:
+    ...     pass
+    ... # doctest: +ELLIPSIS
+    usage: app stop [-h] name
+    ...
+
+    """
+
+    _populate: Optional[Callable[[], None]] = None
+
+    def _ensure_populated(self) -> None:
+        populate, self._populate = self._populate, None
+        if populate is not None:
+            populate()
+
+    def parse_known_args(self, *args: Any, **kwargs: Any) -> Any:
+        self._ensure_populated()
+        return super().parse_known_args(*args, **kwargs)
+
+    def format_usage(self) -> str:
+        self._ensure_populated()
+        return super().format_usage()
+
+    def format_help(self) -> str:
+        self._ensure_populated()
+        return super().format_help()
+
+
 class SubcmdSpec:
+    __slots__ = ("name", "parserspec", "subcmdfn", "argspecs")
     name: str
     parserspec: Dict[str, Any]
     subcmdfn: Union[  # NOTE: Workaround for python/mypy#708.
@@ -207,6 +313,7 @@ class SubcmdSpec:
 
 
 class SubcmdGroup:
+    __slots__ = ("groupspec", "subcmdspecs")
     groupspec: Dict[str, Any]
     subcmdspecs: List[SubcmdSpec]
     subcmdfnname: ClassVar[str] = "_subcmd"
@@ -227,10 +334,18 @@ class CliSpec:
     subcmdgroup: Optional[SubcmdGroup] = None
     reject_unknown_args: bool = True
     envvar_prefix: Optional[str] = None
+    _parser: Optional[argparse.ArgumentParser] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _argnames: Optional[Tuple[str, ...]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
 
     @property
     def argnames(self) -> Tuple[str, ...]:
-        return tuple(s.dest for s in self.argspecs)
+        if self._argnames is None:
+            self._argnames = tuple(s.dest for s in self.argspecs)
+        return self._argnames
 
     def tuplefromargs(self, args: argparse.Namespace) -> Tuple[Any, ...]:
         return tuple(getattr(args, name) for name in self.argnames)
@@ -238,28 +353,67 @@ class CliSpec:
     def namevaluepairsfromargs(
         self, args: argparse.Namespace
     ) -> Iterator[Tuple[str, Any]]:
-        return zip(self.argnames, self.tuplefromargs(args))
+        return ((name, getattr(args, name)) for name in self.argnames)
 
     def makeparser(self) -> argparse.ArgumentParser:
-        def add_arg_to_parser(
-            parser: argparse.ArgumentParser,
-            argspec: ArgSpec,
-        ) -> argparse.ArgumentParser:
-            """Add an argument specification to a parser.
+        """Return the parser for this CLI specification.
 
-            This function modifies and returns the parser argument.
+        The parser is constructed on first use and cached, along with
+        the argument names and the environment variable values read
+        while constructing it. Call `invalidate` after modifying the
+        specification or the environment.
 
-            """
-            _ = parser.add_argument(
-                *argspec.args, **argspec.enhance_kwargs(self.envvar_prefix)
-            )
-            return parser
+        """
+        if self._parser is None:
+            self._parser = self._makeparser()
+        return self._parser
+
+    def invalidate(self) -> None:
+        """Discard all cached state derived from this specification.
+
+        This drops the cached parser and argument names, and calls
+        `ArgSpec.invalidate` on every argument specification, including
+        those of subcommands, to drop cached environment variables and
+        enhanced keyword arguments.
+
+        >>> import os
+        >>> from unittest import mock
+        >>> spec = CliSpec(
+        ...     {"prog": "app"},
+        ...     [ArgSpec("--opt", default="x")],
+        ...     envvar_prefix="DECLARGPARSE_TEST",
+        ... )
+        >>> spec.parseargs([])
+        Namespace(opt='x')
+        >>> env = {"DECLARGPARSE_TEST_OPT": "env1"}
+        >>> with mock.patch.dict(os.environ, env):
+        ...     spec.parseargs([])
+        ...     spec.invalidate()
+        ...     spec.parseargs([])
+        ...     list(spec.getenvvars()[0])
+        Namespace(opt='x')
+        Namespace(opt='env1')
+        ['DECLARGPARSE_TEST_OPT', 'env1']
+
+        """
+        self._parser = None
+        self._argnames = None
+        for argspec in self._allargspecs():
+            argspec.invalidate()
 
-        parser = reduce(
-            add_arg_to_parser,
-            self.argspecs,
-            argparse.ArgumentParser(**self.parserspec),
-        )
+    def _allargspecs(self) -> Iterator[ArgSpec]:
+        yield from self.argspecs
+        if self.subcmdgroup is not None:
+            for scs in self.subcmdgroup.subcmdspecs:
+                yield from scs.argspecs
+
+    def _makeparser(self) -> argparse.ArgumentParser:
+        parser = argparse.ArgumentParser(**{**_COLOR_KW, **self.parserspec})
+        envvar_prefix = self.envvar_prefix
+        for argspec in self.argspecs:
+            parser.add_argument(
+                *argspec.args, **argspec.enhance_kwargs(envvar_prefix)
+            )
         if self.subcmdgroup is not None:
             self._add_subcmdgroup_to_parser(self.subcmdgroup, parser)
         return parser
@@ -269,37 +423,63 @@ class CliSpec:
         subcmdgroup: SubcmdGroup,
         parser: argparse.ArgumentParser,
     ) -> None:
-        subparsers_action = parser.add_subparsers(**subcmdgroup.groupspec)
+        groupspec: Dict[str, Any] = {"parser_class": _LazyArgumentParser}
+        groupspec.update(subcmdgroup.groupspec)
+        subparsers_action = parser.add_subparsers(**groupspec)
         for scs in subcmdgroup.subcmdspecs:
             parser = subparsers_action.add_parser(scs.name, **scs.parserspec)
             parser.set_defaults(**{subcmdgroup.subcmdfnname: scs.subcmdfn})
-            for argspec in scs.argspecs:
-                parser.add_argument(
-                    *argspec.args, **argspec.enhance_kwargs(self.envvar_prefix)
-                )
+
+            def populate(
+                parser: argparse.ArgumentParser = parser,
+                argspecs: Sequence[ArgSpec] = scs.argspecs,
+            ) -> None:
+                for argspec in argspecs:
+                    parser.add_argument(
+                        *argspec.args,
+                        **argspec.enhance_kwargs(self.envvar_prefix),
+                    )
+
+            if isinstance(parser, _LazyArgumentParser):
+                parser._populate = populate
+            else:
+                populate()
 
     def parseargs(
         self,
         arg: Optional[Iterable[str]] = None,
     ) -> argparse.Namespace:
+        """Parse and validate arguments.
+
+        Arguments are taken from `arg` if given, and from `sys.argv`
+        otherwise.
+
+        >>> import sys
+        >>> from unittest import mock
+        >>> spec = CliSpec({"prog": "app"}, [ArgSpec("--opt")])
+        >>> with mock.patch.object(sys, "argv", ["app", "--opt", "argv"]):
+        ...     spec.parseargs(["--opt", "x"])
+        ...     spec.parseargs(iter([]))
+        ...     spec.parseargs()
+        Namespace(opt='x')
+        Namespace(opt=None)
+        Namespace(opt='argv')
+
+        """
+        argv = list(arg) if arg is not None else None
         parser = self.makeparser()
         if self.reject_unknown_args:
-            args = parser.parse_args()
+            args = parser.parse_args(argv)
         else:
-            args, _ = parser.parse_known_args()
+            args, _ = parser.parse_known_args(argv)
         self.validateargs(args)
         return args
 
     def validateargs(self, args: argparse.Namespace) -> None:
-        missingargs = list(
-            map(
-                lambda t: t[0].option_strings,
-                filter(
-                    lambda t: t[0].required and t[1] is None,
-                    zip(self.argspecs, self.tuplefromargs(args)),
-                ),
-            )
-        )
+        missingargs = []
+        for spec, value in zip(self.argspecs, self.tuplefromargs(args)):
+            if spec.required and value is None:
+                missingargs.append(spec.option_strings)
         if missingargs:
             print(
                 "error: the following arguments are required: "
@@ -325,13 +505,35 @@ class CliSpec:
         return self.makeparser().format_help()
 
 
-def fromisoformat(s: str) -> datetime:
+def fromisoformat(s: str) -> "datetime":
     """Return datetime from ISO 8601 string.
 
     >>> fromisoformat("2000-01-01T12:34:56+00:00")
     datetime.datetime(2000, 1, 1, 12, 34, 56, tzinfo=datetime.timezone.utc)
 
+    >>> fromisoformat("2000-01-01T12:34:56+0000")
+    datetime.datetime(2000, 1, 1, 12, 34, 56, tzinfo=datetime.timezone.utc)
+
+    >>> fromisoformat("2000-01-01T12:34:56")
+    ... # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    ValueError: time data '2000-01-01T12:34:56' does not match format
+    >>> fromisoformat("2000-01-01T12:34:56+00:60")
+    ... # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    ValueError: time data '2000-01-01T12:34:56+0060' does not match format
+
     """
-    return datetime.strptime(
-        re.sub(r":(\d\d)$", r"\1", s), "%Y-%m-%dT%H:%M:%S%z"
-    )
+    from datetime import datetime
+
+    # datetime.fromisoformat is much faster than strptime but accepts
+    # more formats, so it is only used for strings in the canonical
+    # format. Before Python 3.11, it also rejects offsets such as +0000.
+    if _ISO_DATETIME_RE.fullmatch(s):
+        try:
+            return datetime.fromisoformat(s)
+        except ValueError:
+            pass
+    return datetime.strptime(_TZ_COLON_RE.sub(r"\1", s), "%Y-%m-%dT%H:%M:%S%z")